@@ -5,29 +5,43 @@
 1. Использует координаты городов из CSV-файла 
    с обязательными полями city, latitude и longitude (по умолчанию `cities_with_coordinates.csv`).
 2. Получает погодные данные с шагом 6 часов для каждого города за указанный период.
-3. Сохраняет результаты в CSV-файл (по умолчанию `hourly_weather.csv`).
-4. Повторно не запрашивает данные для уже обработанных городов (если выходной файл существует).
-5. Добавляет задержку между запросами для защиты от превышения лимитов API.
+3. Дописывает результаты блоками строк (row group, ~500 тыс. строк) в набор Parquet-файлов со сжатием Snappy
+   (по умолчанию каталог `hourly_weather.parquet`, каждый запуск добавляет в него новый файл).
+4. Повторно не запрашивает данные для уже обработанных городов: их список ведётся
+   в файле `_processed.txt` внутри выходного каталога.
+5. Выполняет до `--concurrency` запросов одновременно (httpx + asyncio) через одно
+   HTTP/2-соединение со сжатием ответов (gzip).
+   Частота запросов ограничивается «ведрами токенов» (token bucket) под лимиты API
+   в минуту, в час и в сутки: пока во всех ведрах есть токены, запросы уходят без ожидания.
+   Ведра начинают каждый запуск полными — запросы предыдущих запусков не учитываются.
+   Ответы разбираются в пуле процессов параллельно с загрузкой.
+6. Сохраняет ответы API в SQLite-кэш (по умолчанию `weather_cache.sqlite`) по ключу
+   (координаты, период), поэтому повторный запуск не обращается к сети за уже полученными данными.
 
 Примечание:
 Если необходимо повторно загрузить данные для уже обработанных городов (например, для другого периода),
-укажите новый путь к файлу с помощью параметра `--output` или удалите существующий выходной файл.
+укажите новый путь с помощью параметра `--output` или удалите существующий выходной каталог.
 
 Требования:
   - Python 3.10+
 
 Зависимости:
-  - openmeteo-requests requests-cache retry-requests numpy pandas
+  - httpx[http2] tenacity openmeteo-sdk numpy pandas pyarrow
 
 🛠 Аргументы командной строки:
 --input       Путь к входному CSV с координатами городов (по умолчанию `cities_with_coordinates.csv`)
---output      Путь к выходному CSV для сохранения погодных данных (по умолчанию `hourly_weather.csv`)
+--output      Путь к выходному каталогу Parquet для сохранения погодных данных (по умолчанию `hourly_weather.parquet`)
 --start       Дата начала (обязательный аргумент), формат: YYYY-MM-DD
 --end         Дата окончания (обязательный аргумент), формат: YYYY-MM-DD
---delay       Задержка между запросами в секундах (по умолчанию 30)
+--rate-per-minute  Допустимое число запросов в минуту (по умолчанию 600)
+--rate-per-hour    Допустимое число запросов в час (по умолчанию 5000)
+--rate-per-day     Допустимое число запросов в сутки (по умолчанию 10000)
+--burst       Число запросов, которые можно отправить подряд без ожидания (по умолчанию 10)
+--concurrency Число одновременных запросов (по умолчанию 10)
+--cache       Путь к SQLite-кэшу ответов API (по умолчанию `weather_cache.sqlite`)
 
 ⚙ Использование:
-    python fetch_hourly_weather.py --input 'вх.файл' --output 'выход.файл' --start 2023-01-01 --end 2023-01-10 --delay 15
+    python fetch_hourly_weather.py --input 'вх.файл' --output 'выход.файл' --start 2023-01-01 --end 2023-01-10 --rate-per-minute 300
 
 ⚠ Требуется подключение к интернету.
 ⚠ Использует кэширование и повторные попытки при сбоях подключения.
@@ -37,117 +51,336 @@
 
 import os
 import time
-import json
-import argparse  
-import requests
-import requests_cache
+import atexit
+import signal
+import uuid
+import sqlite3
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import httpx
+import numpy as np
 import pandas as pd
-from retry_requests import retry
-import openmeteo_requests
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_exponential
+from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+from rate_limit import TokenBucket, RateLimits
 
-def main():
-    # --- Аргументы командной строки ---
-    parser = argparse.ArgumentParser(description="Получение погодных данных с шагом 6 часов")
-    parser.add_argument("--input", default="cities_with_coordinates.csv", help="Входной CSV с координатами")
-    parser.add_argument("--output", default="hourly_weather.csv", help="Файл для сохранения данных")
-    parser.add_argument("--start", required=True, help="Дата начала в формате YYYY-MM-DD")
-    parser.add_argument("--end", required=True, help="Дата окончания в формате YYYY-MM-DD")
-    parser.add_argument("--delay", type=int, default=30, help="Задержка между запросами в секундах")
-    args = parser.parse_args()
+API_URL = "https://archive-api.open-meteo.com/v1/archive"
+RETRIES = 5
+BACKOFF_FACTOR = 0.2
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+ROW_GROUP_SIZE = 500_000  # число строк, после которого накопленные данные дописываются в файл
+PROCESSED_FILE = "_processed.txt"  # список сохранённых городов внутри выходного каталога
+
+VAR_NAMES = (
+    "temperature_2m", "relative_humidity_2m", "rain", "snowfall", "snow_depth",
+    "is_day", "precipitation", "wind_direction_100m", "wind_speed_100m"
+)
+
+SCHEMA = pa.schema([
+    ("date", pa.timestamp("s", "UTC")),
+    ("city", pa.string()),
+    ("temperature_2m", pa.float32()),
+    ("relative_humidity_2m", pa.float32()),
+    ("rain", pa.float32()),
+    ("snowfall", pa.float32()),
+    ("snow_depth", pa.float32()),
+    ("is_day", pa.int8()),
+    ("precipitation", pa.float32()),
+    ("wind_direction_100m", pa.float32()),
+    ("wind_speed_100m", pa.float32()),
+])
+COLUMNS = SCHEMA.names
+
+
+def parse_weather_response(data):
+    """Разбирает тело ответа Open-Meteo в формате FlatBuffers и возвращает первый ответ."""
+    length = int.from_bytes(data[:4], byteorder="little")
+    # Ошибки в потоке приходят текстом, начинающимся с "Unexpected"
+    if length == 0x78656E55:
+        raise ValueError(data.decode("utf-8"))
+    return WeatherApiResponse.GetRootAs(data, 4)
+
+
+def is_retriable(e):
+    """Повторяем запрос при сетевых сбоях и ответах 429/5xx."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUSES
+    return isinstance(e, httpx.TransportError)
+
+
+async def download(client, sem, limiter, params):
+    async with sem:
+        retrying = AsyncRetrying(
+            retry=retry_if_exception(is_retriable),
+            stop=stop_after_attempt(RETRIES),
+            wait=wait_exponential(multiplier=BACKOFF_FACTOR),
+            reraise=True
+        )
+        async for attempt in retrying:
+            with attempt:
+                await limiter.acquire()
+                r = await client.get(API_URL, params=params)
+                r.raise_for_status()
+    return r.content
+
+
+def response_key(lat, lon, start_date, end_date):
+    # Набор переменных входит в ключ: при изменении VAR_NAMES старые ответы из кэша не используются
+    raw = f"{lat},{lon},{start_date},{end_date},hourly_6,{','.join(VAR_NAMES)}"
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
+
+
+def open_response_cache(cache_path):
+    """Открывает SQLite-кэш сырых ответов API (тела в формате FlatBuffers)."""
+    conn = sqlite3.connect(cache_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS resp(key TEXT PRIMARY KEY, body BLOB, ts INTEGER)")
+    return conn
+
+
+async def fetch_city(client, sem, limiter, cache, key, lat, lon, start_date, end_date):
+    """Возвращает сырое тело ответа для города и признак того, что оно взято из кэша."""
+    # Сначала ищем сырой ответ в кэше, в сеть идём только при промахе
+    cached = cache.execute("SELECT body FROM resp WHERE key=?", (key,)).fetchone()
+    if cached is not None:
+        return cached[0], True
+
+    params = {
+        "latitude": lat,
+        "longitude": lon,
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": ",".join(VAR_NAMES),
+        "temporal_resolution": "hourly_6",
+        "format": "flatbuffers"
+    }
+    return await download(client, sem, limiter, params), False
+
+
+def build_hourly_data(body, city):
+    """Разбирает сырой ответ в словарь колонок. Выполняется в отдельном процессе."""
+    hourly = parse_weather_response(body).Hourly()
+    # openmeteo_sdk не проверяет границы при обращении к Variables(i)
+    if hourly.VariablesLength() != len(VAR_NAMES):
+        raise ValueError(f"ожидалось переменных: {len(VAR_NAMES)}, в ответе: {hourly.VariablesLength()}")
+
+    # Переменные приходят в том же порядке, в каком перечислены в запросе (VAR_NAMES)
+    arrays = [hourly.Variables(i).ValuesAsNumpy().astype(np.float32, copy=False) for i in range(len(VAR_NAMES))]
+    hourly_data = {
+        "date": np.arange(hourly.Time(), hourly.TimeEnd(), hourly.Interval(), dtype=np.int64).astype("datetime64[s]"),
+        "city": city,
+    }
+    hourly_data.update(zip(VAR_NAMES, arrays))
+    hourly_data["is_day"] = hourly_data["is_day"].astype(np.int8)
+    return hourly_data
+
+
+def build_frame(results):
+    """Собирает один DataFrame из списка словарей с массивами, без промежуточных concat."""
+    lengths = [len(d["date"]) for d in results]
+    columns = {col: np.concatenate([d[col] for d in results]) for col in COLUMNS if col != "city"}
+    columns["city"] = np.repeat([d["city"] for d in results], lengths)
+    columns["date"] = pd.DatetimeIndex(columns["date"], tz="UTC")
+    return pd.DataFrame(columns, columns=COLUMNS)
 
-    input_path = args.input
-    output_path = args.output
-    start_date = args.start
-    end_date = args.end
-    delay = args.delay
 
+def read_processed_cities(output_path):
+    """Возвращает множество городов, уже сохранённых в выходной каталог."""
+    processed_path = os.path.join(output_path, PROCESSED_FILE)
+    if not os.path.exists(processed_path):
+        return set()
+    with open(processed_path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+class StreamingWriter:
+    """
+    Дописывает данные городов порциями в Parquet-файл текущего запуска.
+
+    Файл пишется под служебным именем (с префиксом `_`, его не видят читатели каталога)
+    и переименовывается в `part-*.parquet` только при закрытии, после чего города
+    добавляются в список обработанных. Закрытие гарантируется при выходе из `with`
+    (в том числе по SIGTERM, который превращается в SystemExit) и при завершении
+    интерпретатора (atexit); если процесс
+    убит жёстко, недописанный файл игнорируется, а города будут запрошены
+    заново (из кэша ответов).
+    """
+
+    def __init__(self, output_path, row_group_size=ROW_GROUP_SIZE):
+        self.output_path = output_path
+        self.row_group_size = row_group_size
+        self.buffer = []
+        self.buffered_rows = 0
+        self.written_cities = []
+        self.new_cities = set()
+        self._writer = None
+        self._closed = False
+        # Случайный суффикс: запуски, завершившиеся в одну секунду, не перезапишут файлы друг друга
+        stamp = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex}"
+        self._part_path = os.path.join(output_path, f"part-{stamp}.parquet")
+        self._tmp_path = os.path.join(output_path, f"_part-{stamp}.parquet.inprogress")
+
+    def __enter__(self):
+        os.makedirs(self.output_path, exist_ok=True)
+        atexit.register(self.close)
+        self._prev_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _on_sigterm(self, signum, frame):
+        # Только завершаем работу: файл закроет __exit__ (или atexit). Вызов close() отсюда
+        # мог бы прервать flush() на середине и записать тот же буфер дважды.
+        raise SystemExit(128 + signum)
+
+    def write(self, hourly_data):
+        self.buffer.append(hourly_data)
+        self.buffered_rows += len(hourly_data["date"])
+        # Копим целую группу строк: крупные row group дешевле читать по колонкам
+        if self.buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        # Забираем буфер сразу, чтобы прерванный flush() не записал его повторно
+        buffer, self.buffer = self.buffer, []
+        self.buffered_rows = 0
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(
+                self._tmp_path, SCHEMA,
+                compression="snappy",
+                use_dictionary=["city"],
+                data_page_size=1 << 20
+            )
+        df = build_frame(buffer)
+        # Каждый сброс буфера становится одной группой строк (row group)
+        table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+        self._writer.write_table(table, row_group_size=len(table))
+        self.written_cities.extend(d["city"] for d in buffer)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        signal.signal(signal.SIGTERM, self._prev_sigterm)
+        self.flush()
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._tmp_path, self._part_path)
+        with open(os.path.join(self.output_path, PROCESSED_FILE), "a", encoding="utf-8") as f:
+            f.writelines(f"{city}\n" for city in self.written_cities)
+        self.new_cities.update(self.written_cities)
+
+
+async def main_async(input_path, output_path, cache_path, start_date, end_date,
+                     rate_per_minute, rate_per_hour, rate_per_day, burst, concurrency):
     # --- Проверка уже обработанных городов ---
-    processed_cities = set()
-    if os.path.exists(output_path):
-        existing_df = pd.read_csv(output_path)
-        processed_cities = set(existing_df["city"].unique())
+    processed_cities = read_processed_cities(output_path)
+    if processed_cities:
         print(f" Уже обработаны города: {processed_cities}")
 
     data = pd.read_csv(input_path)
     data = data[~data["city"].isin(processed_cities)]
+    cities = data["city"].to_numpy()
+    lats = data["latitude"].to_numpy(dtype=np.float64)
+    lons = data["longitude"].to_numpy(dtype=np.float64)
 
-    # --- Настройка клиента с кэшем и ретраями ---
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-
-    all_results = []
-
-    for index, row in data.iterrows():
-        params = {
-            "latitude": row["latitude"],
-            "longitude": row["longitude"],
-            "start_date": start_date,
-            "end_date": end_date,
-            "hourly": [
-                "temperature_2m", "relative_humidity_2m", "rain", "snowfall", "snow_depth",
-                "is_day", "precipitation", "wind_direction_100m", "wind_speed_100m"
-            ],
-            "temporal_resolution": "hourly_6"
-        }
+    # --- Параллельная загрузка с ограничением числа одновременных запросов ---
+    sem = asyncio.Semaphore(concurrency)
+    limiter = RateLimits(
+        TokenBucket(capacity=burst, refill_rate=rate_per_minute / 60),
+        TokenBucket(capacity=rate_per_hour, refill_rate=rate_per_hour / 3600),
+        TokenBucket(capacity=rate_per_day, refill_rate=rate_per_day / 86400)
+    )
+    cache = open_response_cache(cache_path)
 
-        try:
-            responses = openmeteo.weather_api("https://archive-api.open-meteo.com/v1/archive", params=params)
-            response = responses[0]
-            hourly = response.Hourly()
-
-            hourly_data = {
-                "date": pd.date_range(
-                    start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-                    end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-                    freq=pd.Timedelta(seconds=hourly.Interval()),
-                    inclusive="left"
-                ),
-                "city": row["city"],
-                "temperature_2m": hourly.Variables(0).ValuesAsNumpy(),
-                "relative_humidity_2m": hourly.Variables(1).ValuesAsNumpy(),
-                "rain": hourly.Variables(2).ValuesAsNumpy(),
-                "snowfall": hourly.Variables(3).ValuesAsNumpy(),
-                "snow_depth": hourly.Variables(4).ValuesAsNumpy(),
-                "is_day": hourly.Variables(5).ValuesAsNumpy(),
-                "precipitation": hourly.Variables(6).ValuesAsNumpy(),
-                "wind_direction_100m": hourly.Variables(7).ValuesAsNumpy(),
-                "wind_speed_100m": hourly.Variables(8).ValuesAsNumpy(),
-            }
-
-            df = pd.DataFrame(hourly_data)
-            all_results.append(df)
-            print(f"Данные получены для города {row['city']}. Ждём {delay} сек...")
-            time.sleep(delay)
+    loop = asyncio.get_running_loop()
 
+    async def process_city(client, executor, writer, city, lat, lon):
+        key = response_key(lat, lon, start_date, end_date)
+        try:
+            body, from_cache = await fetch_city(client, sem, limiter, cache, key, lat, lon, start_date, end_date)
+            # Разбор ответа уходит в пул процессов, цикл событий тем временем продолжает загрузку
+            try:
+                hourly_data = await loop.run_in_executor(executor, build_hourly_data, body, city)
+            except Exception:
+                if not from_cache:
+                    raise
+                # Запись в кэше не разбирается: удаляем её и скачиваем ответ заново
+                with cache:
+                    cache.execute("DELETE FROM resp WHERE key=?", (key,))
+                body, from_cache = await fetch_city(client, sem, limiter, cache, key, lat, lon, start_date, end_date)
+                hourly_data = await loop.run_in_executor(executor, build_hourly_data, body, city)
         except Exception as e:
-            print(f"Ошибка при обработке города {row['city']}: {e}")
-            if all_results:
-                print("Сохраняем уже полученные данные перед выходом...")
-                new_df = pd.concat(all_results, ignore_index=True)
-                if os.path.exists(output_path):
-                    existing_df = pd.read_csv(output_path)
-                    final_df = pd.concat([existing_df, new_df], ignore_index=True)
-                else:
-                    final_df = new_df
-                final_df.to_csv(output_path, index=False)
-                print(f"Данные сохранены в {output_path}")
-            else:
-                print("⚠ Нет данных для сохранения.")
-            break
+            print(f"Ошибка при обработке города {city}: {e}")
+            return
+        if not from_cache:
+            with cache:
+                cache.execute("INSERT OR REPLACE INTO resp(key, body, ts) VALUES (?, ?, ?)",
+                              (key, body, int(time.time())))
+        print(f"Данные получены для города {city}.")
+        writer.write(hourly_data)
 
+    try:
+        # Все запросы идут через одно HTTP/2-соединение с мультиплексированием
+        with StreamingWriter(output_path) as writer, \
+                ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            async with httpx.AsyncClient(
+                http2=True,
+                headers={"Accept-Encoding": "gzip"},
+                limits=httpx.Limits(max_connections=1, max_keepalive_connections=1),
+                timeout=30
+            ) as client:
+                tasks = [process_city(client, executor, writer, cities[i], lats[i], lons[i])
+                         for i in range(len(data))]
+                await asyncio.gather(*tasks)
+    finally:
+        cache.close()
+
+    if writer.new_cities:
+        print(f"Данные для {len(writer.new_cities)} городов сохранены в {output_path}")
     else:
-        if all_results:
-            new_df = pd.concat(all_results, ignore_index=True)
-            if os.path.exists(output_path):
-                existing_df = pd.read_csv(output_path)
-                final_df = pd.concat([existing_df, new_df], ignore_index=True)
-            else:
-                final_df = new_df
-            final_df.to_csv(output_path, index=False)
-            print(f"Все данные успешно сохранены в {output_path}")
-        else:
-            print("⚠ Нет новых данных для сохранения.")
+        print("⚠ Нет новых данных для сохранения.")
+
+
+def positive(type_):
+    """Тип аргумента argparse, допускающий только значения больше нуля."""
+    def parse(value):
+        number = type_(value)
+        if number <= 0:
+            raise argparse.ArgumentTypeError(f"значение должно быть больше 0: {value}")
+        return number
+    parse.__name__ = type_.__name__
+    return parse
+
+
+def main():
+    # --- Аргументы командной строки ---
+    parser = argparse.ArgumentParser(description="Получение погодных данных с шагом 6 часов")
+    parser.add_argument("--input", default="cities_with_coordinates.csv", help="Входной CSV с координатами")
+    parser.add_argument("--output", default="hourly_weather.parquet", help="Каталог Parquet для сохранения данных")
+    parser.add_argument("--start", required=True, help="Дата начала в формате YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="Дата окончания в формате YYYY-MM-DD")
+    parser.add_argument("--rate-per-minute", type=positive(float), default=600, help="Допустимое число запросов в минуту")
+    parser.add_argument("--rate-per-hour", type=positive(float), default=5000, help="Допустимое число запросов в час")
+    parser.add_argument("--rate-per-day", type=positive(float), default=10000, help="Допустимое число запросов в сутки")
+    parser.add_argument("--burst", type=positive(int), default=10, help="Число запросов подряд без ожидания")
+    parser.add_argument("--concurrency", type=positive(int), default=10, help="Число одновременных запросов")
+    parser.add_argument("--cache", default="weather_cache.sqlite", help="SQLite-кэш ответов API")
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args.input, args.output, args.cache, args.start, args.end,
+                           args.rate_per_minute, args.rate_per_hour, args.rate_per_day,
+                           args.burst, args.concurrency))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,48 @@
+"""
+Общий ограничитель частоты запросов к внешним API («ведро токенов», token bucket).
+
+Используется скриптами `fetch_hourly_weather.py` (Open-Meteo) и
+`russian_cities_with_coords.py` (Nominatim).
+"""
+
+
+import time
+import asyncio
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов: не более `capacity` подряд и `refill_rate` запросов в секунду."""
+
+    def __init__(self, capacity, refill_rate):
+        # При capacity < 1 токен никогда не накопится и acquire() зависнет навсегда
+        if capacity < 1 or refill_rate <= 0:
+            raise ValueError("capacity должен быть не меньше 1, а refill_rate — больше 0")
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def consume(self):
+        """Забирает токен и возвращает 0 либо возвращает время ожидания до появления токена."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.refill_rate
+
+    async def acquire(self):
+        while (wait := self.consume()) > 0:
+            await asyncio.sleep(wait)
+
+
+class RateLimits:
+    """Набор ограничителей (например, лимиты в минуту, в час и в сутки): запрос ждёт, пока разрешат все."""
+
+    def __init__(self, *buckets):
+        self.buckets = buckets
+
+    async def acquire(self):
+        for bucket in self.buckets:
+            await bucket.acquire()
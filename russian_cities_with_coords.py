@@ -7,21 +7,28 @@
 2. Очищает и форматирует данные (названия, регионы, население).
 3. Выделяет непризнанные города (с пометкой "не призн.") в отдельный CSV-файл
    (геокодирование непризнанных городов в рамках этого скрипта не проводится).
-4. Геокодирует оставшиеся города через OpenStreetMap (Nominatim).
-5. Кэширует координаты для избежания повторных запросов.
+4. Находит координаты оставшихся городов в офлайн-выгрузке GeoNames (`cities500.zip`),
+   сверяя регион, а города, которых там нет (или название в регионе неоднозначно), асинхронно геокодирует
+   через OpenStreetMap (Nominatim) структурированным запросом, соблюдая лимит
+   сервиса в 1 запрос в секунду.
+5. Кэширует координаты в SQLite для избежания повторных запросов
+   (в сеть уходят только города, которых ещё нет в кэше).
 6. Сохраняет результат в файл с координатами.
 
 Требования:
   - Python 3.10+
 
 Зависимости:
-  - pandas requests tqdm geopy
+  - pandas requests httpx[http2] tqdm
 
 Файлы:
 - `russian_cities.csv` — очищенные и признанные города России.
 - `unrecognized_cities.csv` — города с пометкой "не призн.".
 - `cities_with_coordinates.csv` — города с координатами.
-- `geo_cache.json` — кэш координат, чтобы не перегружать API.
+- `geo_cache.sqlite` — кэш координат (SQLite), чтобы не перегружать API.
+- `geo_cache.json` — старый кэш координат; если он есть, при первом запуске переносится в `geo_cache.sqlite`
+  (дальше не используется и может быть удалён).
+- `cities500.zip` — выгрузка GeoNames (скачивается автоматически при первом запуске).
 
 ⚠ Требует интернет-соединения и может занять время (около 20 мин), особенно при первом запуске.
 
@@ -33,19 +40,122 @@
 
 
 import os
-import time
 import json
+import re
+import csv
+import random
+import asyncio
+import sqlite3
+import zipfile
+import httpx
 import requests
 import pandas as pd
 from io import StringIO
-from tqdm import tqdm
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
+from collections import Counter
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from tqdm.asyncio import tqdm_asyncio
+from rate_limit import TokenBucket
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+GEONAMES_URL = "https://download.geonames.org/export/dump/cities500.zip"
+GEONAMES_MIN_POPULATION = 1000
+CYRILLIC = re.compile('[а-яё]', re.IGNORECASE)
+GEOCODE_ATTEMPTS = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Общая сессия для синхронных запросов (Википедия, GeoNames): переиспользует соединения
+# и сама повторяет запрос при сбоях и ответах 429/5xx
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+))
+
+
+def normalize_name(name):
+    return name.strip().lower().replace('ё', 'е')
+
+
+def load_geonames(geonames_path):
+    """
+    Загружает города и посёлки России из выгрузки GeoNames (типы PPL, PPLC, PPLA*,
+    население не меньше GEONAMES_MIN_POPULATION) в словарь
+    {нормализованное название: [(широта, долгота, код региона admin1), ...]}.
+    """
+    if not os.path.exists(geonames_path):
+        print(f"Скачиваем выгрузку GeoNames в {geonames_path}...")
+        # Качаем во временный файл и переименовываем только после полной загрузки,
+        # чтобы прерванная загрузка не оставила обрезанный архив
+        part_path = geonames_path + '.part'
+        try:
+            with session.get(GEONAMES_URL, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    f.writelines(response.iter_content(chunk_size=1 << 20))
+        except requests.RequestException as e:
+            print(f"⚠ Не удалось скачать GeoNames ({e}), все города будут геокодированы через Nominatim.")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return {}
+        os.replace(part_path, geonames_path)
+
+    places = {}
+    try:
+        with zipfile.ZipFile(geonames_path) as zf:
+            name = os.path.splitext(os.path.basename(geonames_path))[0] + '.txt'
+            with zf.open(name) as f:
+                lines = (line.decode('utf-8') for line in f)
+                for row in csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE):
+                    # Колонки: 1 — название, 2 — ASCII-название, 3 — альтернативные названия,
+                    # 4/5 — широта/долгота, 7 — код типа объекта, 8 — код страны,
+                    # 10 — код региона (admin1), 14 — население
+                    if row[8] != 'RU' or not is_town(row[7]) or int(row[14] or 0) < GEONAMES_MIN_POPULATION:
+                        continue
+                    # Основное и ASCII-названия в GeoNames латинские, русское название есть
+                    # только среди альтернативных — из них берём лишь написанные кириллицей
+                    alternates = [n for n in row[3].split(',') if CYRILLIC.search(n)]
+                    names = {normalize_name(n) for n in [row[1], row[2], *alternates] if n}
+                    for n in names:
+                        places.setdefault(n, []).append((float(row[4]), float(row[5]), row[10]))
+    except zipfile.BadZipFile as e:
+        # Повреждённый архив удаляем, чтобы следующий запуск скачал его заново
+        print(f"⚠ Выгрузка GeoNames повреждена ({e}), все города будут геокодированы через Nominatim.")
+        os.remove(geonames_path)
+        return {}
+    return places
+
+
+def is_town(feature_code):
+    return feature_code in ('PPL', 'PPLC') or feature_code.startswith('PPLA')
+
+
+def guess_region_codes(places, cities, regions):
+    """
+    Сопоставляет регионы из Википедии с кодами регионов GeoNames (admin1) без таблицы
+    перевода названий: регион получает код, который имеет большинство его городов
+    с единственным совпадением по названию (нужно не меньше двух таких городов).
+    """
+    votes = {}
+    for city, region in zip(cities, regions):
+        candidates = places.get(normalize_name(city), [])
+        if len(candidates) == 1:
+            votes.setdefault(region, Counter())[candidates[0][2]] += 1
+    codes = {}
+    for region, counter in votes.items():
+        code, count = counter.most_common(1)[0]
+        if count >= 2 and count * 2 > sum(counter.values()):
+            codes[region] = code
+    return codes
+
 
 def fetch_and_geocode_russian_cities(csv_path='russian_cities.csv',
                                       unrecognized_path='unrecognized_cities.csv',
                                       output_path='cities_with_coordinates.csv',
-                                      cache_file='geo_cache.json'):
+                                      cache_file='geo_cache.sqlite',
+                                      legacy_cache_file='geo_cache.json',
+                                      geonames_path='cities500.zip'):
     # --- Шаг 1: Получение и обработка списка городов ---
     print("Получаем список городов России с Википедии...")
     api_url = "https://ru.wikipedia.org/w/api.php"
@@ -57,7 +167,8 @@ def fetch_and_geocode_russian_cities(csv_path='russian_cities.csv',
         'section': 1
     }
 
-    response = requests.get(api_url, params=params)
+    response = session.get(api_url, params=params, timeout=30)
+    response.raise_for_status()
     data = response.json()
     html = data['parse']['text']['*']
     dfs = pd.read_html(StringIO(html))
@@ -69,8 +180,9 @@ def fetch_and_geocode_russian_cities(csv_path='russian_cities.csv',
         'Население': 'population'
     })
     df = df[['city', 'region', 'population']]
-    df['population'] = df['population'].astype(str).str.replace(r'\D', '', regex=True)
-    df['population'] = pd.to_numeric(df['population'], errors='coerce').fillna(0).astype(int)
+    # Одним проходом регулярного выражения убираем сноски вида [1] и разделители разрядов
+    population = df['population'].astype(str).str.replace(r'\[[^\]]*\]|\D', '', regex=True)
+    df['population'] = pd.to_numeric(population, errors='coerce').fillna(0).astype('int32')
 
     region_map = {
         "Ханты-Мансийский АО": "Ханты-Мансийский автономный округ",
@@ -92,47 +204,128 @@ def fetch_and_geocode_russian_cities(csv_path='russian_cities.csv',
 
     # --- Шаг 2: Геокодирование городов ---
     print("\n Начинаем геокодирование городов...")
-    geolocator = Nominatim(user_agent="geoapi")
 
-    if os.path.exists(cache_file):
-        with open(cache_file, "r", encoding="utf-8") as f:
-            cache = json.load(f)
-    else:
-        cache = {}
+    conn = sqlite3.connect(cache_file)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("CREATE TABLE IF NOT EXISTS geo(key TEXT PRIMARY KEY, lat REAL, lon REAL)")
 
-    def get_coordinates(city, region):
-        key = f"{city}, {region}"
-        if key in cache:
-            return cache[key]
-        try:
-            location = geolocator.geocode(f"{city}, {region}, Russia", timeout=10)
-            if location:
-                coords = (location.latitude, location.longitude)
-            else:
-                coords = (None, None)
-        except GeocoderTimedOut:
-            time.sleep(1)
-            return get_coordinates(city, region)
-        cache[key] = coords
-        return coords
+    # Однократно переносим старый JSON-кэш, чтобы не геокодировать заново уже известные города
+    if os.path.exists(legacy_cache_file) and conn.execute("SELECT 1 FROM geo LIMIT 1").fetchone() is None:
+        with open(legacy_cache_file, "r", encoding="utf-8") as f:
+            legacy_cache = json.load(f)
+        # Ненайденные города хранились как [null, null] — они становятся NULL в таблице
+        conn.executemany("INSERT OR IGNORE INTO geo(key, lat, lon) VALUES (?, ?, ?)",
+                         ((key, *(coords or (None, None))) for key, coords in legacy_cache.items()))
+        conn.commit()
+        print(f"Кэш из {legacy_cache_file} перенесён в {cache_file}: {len(legacy_cache)} записей")
 
     df = pd.read_csv(csv_path)
-    tqdm.pandas()
+    keys = [f"{city}, {region}" for city, region in zip(df['city'].values, df['region'].values)]
+
+    # Одним проходом по кэшу отбираем уже известные координаты (пачками из-за лимита параметров SQLite)
+    cache = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for start in range(0, len(unique_keys), 500):
+        chunk = unique_keys[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT key, lat, lon FROM geo WHERE key IN ({placeholders})", chunk)
+        cache.update((key, (lat, lon)) for key, lat, lon in rows)
+
+    misses = {key: (city, region)
+              for key, city, region in zip(keys, df['city'].values, df['region'].values)
+              if key not in cache}
+    pending_writes = 0
+
+    def save_coordinates(key, coords):
+        nonlocal pending_writes
+        cache[key] = coords
+        conn.execute("INSERT OR REPLACE INTO geo(key, lat, lon) VALUES (?, ?, ?)", (key, *coords))
+        pending_writes += 1
+        # Фиксируем изменения пачками, чтобы не делать commit на каждый город
+        if pending_writes >= 50:
+            conn.commit()
+            pending_writes = 0
+
+    # Сначала ищем города в офлайн-выгрузке GeoNames, в сеть идут только оставшиеся
+    if misses:
+        places = load_geonames(geonames_path)
+        region_codes = guess_region_codes(places, df['city'].values, df['region'].values)
+        found = 0
+        for key, (city, region) in list(misses.items()):
+            # Берём координаты, только если в нужном регионе ровно один пункт с таким названием
+            code = region_codes.get(region)
+            matches = [c for c in places.get(normalize_name(city), []) if c[2] == code]
+            if code is not None and len(matches) == 1:
+                save_coordinates(key, matches[0][:2])
+                del misses[key]
+                found += 1
+        print(f"Найдено в GeoNames: {found}, осталось геокодировать через Nominatim: {len(misses)}")
+
+    async def search(client, sem, bucket, params):
+        # Ограниченное число попыток с экспоненциальной задержкой и случайным разбросом (full jitter),
+        # чтобы повторы не накатывали на Nominatim одновременно. None — сервис так и не дал ответа,
+        # ошибка одного города не должна прерывать геокодирование остальных.
+        async with sem:
+            for attempt in range(GEOCODE_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(random.uniform(0, 2 ** attempt * 0.1))
+                await bucket.acquire()
+                try:
+                    response = await client.get(NOMINATIM_URL, params=params)
+                    response.raise_for_status()
+                    return response.json()
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in RETRY_STATUSES:
+                        return None
+                except (httpx.TransportError, ValueError):
+                    # Сетевой сбой или тело ответа не JSON
+                    pass
+        return None
+
+    async def get_coordinates(client, sem, bucket, key, city, region):
+        # Структурированный запрос точнее и дешевле для Nominatim; свободный текст — запасной вариант
+        params = {'city': city, 'state': region, 'country': 'Russia', 'format': 'json', 'limit': 1}
+        results = await search(client, sem, bucket, params)
+        if results == []:
+            params = {'q': f"{city}, {region}, Russia", 'format': 'json', 'limit': 1}
+            results = await search(client, sem, bucket, params)
+        if results is None:
+            # Сбой сервиса не означает, что город не найден: в кэш не пишем, чтобы повторить при следующем запуске
+            cache[key] = (None, None)
+            return
+        if results:
+            coords = (float(results[0]['lat']), float(results[0]['lon']))
+        else:
+            coords = (None, None)
+        save_coordinates(key, coords)
 
-    def fill_missing_coords(row):
-        return pd.Series(get_coordinates(row['city'], row['region']))
+    async def geocode_misses():
+        # Nominatim допускает не более 1 запроса в секунду
+        sem = asyncio.Semaphore(1)
+        bucket = TokenBucket(capacity=1, refill_rate=1)
+        async with httpx.AsyncClient(http2=True, headers={'User-Agent': 'geoapi'}, timeout=10) as client:
+            tasks = [get_coordinates(client, sem, bucket, key, city, region)
+                     for key, (city, region) in misses.items()]
+            await tqdm_asyncio.gather(*tasks)
 
-    df[['latitude', 'longitude']] = df.progress_apply(fill_missing_coords, axis=1)
+    try:
+        if misses:
+            asyncio.run(geocode_misses())
+    finally:
+        conn.commit()
+        conn.close()
 
+    df[['latitude', 'longitude']] = pd.DataFrame([cache[key] for key in keys], index=df.index, dtype=float)
     df.to_csv(output_path, index=False)
-    with open(cache_file, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
 
     missing_coords = df[df['latitude'].isna() | df['longitude'].isna()]
     if not missing_coords.empty:
         print("\n Не удалось получить координаты для следующих городов:")
-        for _, row in missing_coords.iterrows():
-            print(f"- {row['city']} ({row['region']})")
+        for city, region in zip(missing_coords['city'].values, missing_coords['region'].values):
+            print(f"- {city} ({region})")
     else:
         print("\n Все города успешно геокодированы.")
 